@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time :func:`fastdupes.groupBy` end-to-end on synthetic size and digest
+columns.
+
+Each classifier is run twice over the same input: once through the bulk
+path (:func:`fastdupes.batchGroup`) and once through the per-file path
+which :func:`fastdupes.groupify` wrappers use when ``keep_uniques`` is set.
+The key functions only look values up in a dict, so the timings measure
+grouping overhead rather than I/O.
+
+Usage: ``python benchmarks/grouping.py [--count=N] [--runs=N]``
+"""
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import hashlib, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import fastdupes  # pylint: disable=wrong-import-position
+
+def make_columns(count):
+    """Build synthetic paths with size-like and digest-like keys.
+
+    About half of the sizes and a third of the digests are shared with at
+    least one other path, which is roughly what a home directory looks like.
+
+    :rtype: ``(list, dict, dict)``
+    """
+    rand = random.Random(42)
+    paths = ['/data/%07d' % x for x in xrange(count)]
+    sizes = dict((x, rand.randint(0, count)) for x in paths)
+    digests = dict((x, hashlib.sha1(str(rand.randint(0, count * 2)))
+                    .digest()) for x in paths)
+    return paths, sizes, digests
+
+def per_file(key_function):
+    """Wrap ``key_function`` so :func:`fastdupes.groupBy` can't use its bulk
+    path."""
+    wrapper = fastdupes.groupify(key_function)
+    del wrapper.key_function
+    return wrapper
+
+def best_time(func, runs):
+    """Return the fastest of ``runs`` calls to ``func`` in seconds."""
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    """The main entry point."""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]",
+                          description=__doc__.split('\n\n')[0])
+    parser.add_option('--count', type='int', default=10 ** 6, metavar='N',
+        help="Number of synthetic paths (default: %default)")
+    parser.add_option('--runs', type='int', default=3, metavar='N',
+        help="Take the best of this many runs (default: %default)")
+    opts, _ = parser.parse_args()
+
+    fastdupes.out.write = lambda *args, **kwargs: None  # Quiet progress
+    paths, sizes, digests = make_columns(opts.count)
+    groups = {'': paths}
+
+    try:
+        import numpy  # pylint: disable=unused-variable
+        backend = 'numpy'
+    except ImportError:
+        backend = 'sorted()'
+    print("%d paths, batchGroup using %s" % (opts.count, backend))
+
+    for name, keys in (('sizes', sizes), ('digests', digests)):
+        key_function = fastdupes.groupify(keys.get)
+        bulk = best_time(lambda: fastdupes.groupBy(groups, key_function),
+                         opts.runs)
+        single = best_time(lambda: fastdupes.groupBy(
+            groups, per_file(keys.get)), opts.runs)
+        print("%-8s bulk: %6.2fs  per-file: %6.2fs" % (name, bulk, single))
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sw=4 sts=4 expandtab :
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check that a plain scan of one small file starts up quickly.
+
+Runs ``fastdupes.py <tmpfile>`` several times, compares the best wall-clock
+time against a bare ``python -c pass`` and fails if the difference exceeds
+the budget. It also fails if the plain-scan path pulls in any of the modules
+which :mod:`fastdupes` is meant to import only when they're needed.
+
+Usage: ``python benchmarks/startup.py [--budget=MS] [--runs=N]``
+"""
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, subprocess, sys, tempfile, time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'fastdupes.py')
+
+#: Modules which a plain scan must not import
+LAZY_MODULES = ['collections', 'ctypes', 'io', 'json', 'mmap', 'optparse',
+                'shutil', 'sqlite3', 'tarfile', 'threading', 'zipfile']
+
+#: Prints whichever of LAZY_MODULES a plain scan of argv[1] loaded
+MODULE_CHECK = """
+import sys
+before = set(sys.modules)
+sys.path.insert(0, %r)
+sys.argv = ['fastdupes', sys.argv[1]]
+import fastdupes
+fastdupes.main()
+print(' '.join(sorted(x for x in %r
+                      if x in sys.modules and x not in before)))
+""" % (os.path.dirname(SCRIPT), LAZY_MODULES)
+
+def best_time(argv, runs):
+    """Run a command ``runs`` times and return the fastest wall-clock time.
+
+    :param argv: The command to run.
+    :type argv: :class:`~__builtins__.list`
+
+    :rtype: :class:`~__builtins__.float`
+    """
+    devnull, best = open(os.devnull, 'w'), None
+    try:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        devnull.close()
+    return best
+
+def main():
+    """The main entry point."""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]",
+                          description=__doc__.split('\n\n')[0])
+    parser.add_option('--budget', type='float', default=20, metavar='MS',
+        help="Maximum allowed overhead over a bare interpreter in "
+             "milliseconds (default: %default)")
+    parser.add_option('--runs', type='int', default=20, metavar='N',
+        help="Take the best of this many runs (default: %default)")
+    parser.add_option('--python', default=sys.executable, metavar='PATH',
+        help="Interpreter to test with (default: %default)")
+    opts, _ = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(prefix='fastdupes-startup-')
+    try:
+        os.write(fd, b'startup benchmark\n')
+        os.close(fd)
+
+        baseline = best_time([opts.python, '-c', 'pass'], opts.runs)
+        scan = best_time([opts.python, SCRIPT, path], opts.runs)
+        loaded = subprocess.Popen([opts.python, '-c', MODULE_CHECK, path],
+                                  stdout=subprocess.PIPE,
+                                  stderr=open(os.devnull, 'w')
+                                  ).communicate()[0].decode().split()
+    finally:
+        os.remove(path)
+
+    overhead = (scan - baseline) * 1000
+    print("python -c pass:       %6.1f ms" % (baseline * 1000))
+    print("fastdupes.py <file>:  %6.1f ms" % (scan * 1000))
+    print("overhead:             %6.1f ms (budget %.1f ms)" % (overhead,
+                                                             opts.budget))
+
+    failed = False
+    if overhead > opts.budget:
+        print("FAIL: startup overhead is over budget")
+        failed = True
+    if loaded:
+        print("FAIL: plain scan imported %s" % ', '.join(loaded))
+        failed = True
+    if not failed:
+        print("OK")
+    sys.exit(failed and 1 or 0)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sw=4 sts=4 expandtab :
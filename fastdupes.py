@@ -38,8 +38,12 @@ __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __version__ = "0.3.6"
 __license__ = "GNU GPL 2.0 or later"
 
-import fnmatch, os, re, stat, sys
+# Keep this list short. Anything not needed for a plain scan (eg. sqlite3,
+# json, optparse) is imported where it's used to keep startup fast for
+# callers which invoke us many times on small inputs.
+import errno, fnmatch, os, re, stat, sys, time
 from functools import wraps
+from thread import allocate_lock  # Much cheaper to import than threading
 
 # Note: In my `python -m timeit` tests, the difference between MD5 and SHA1 was
 # negligible, so there is no meaningful reason not to take advantage of the
@@ -48,12 +52,24 @@ import hashlib
 
 #: Default settings used by :mod:`optparse` and some functions
 DEFAULTS = {
+    'db': None,
     'delete': False,
     'exclude': ['*/.svn', '*/.bzr', '*/.git', '*/.hg'],
+    'jobs': 4,  #: Number of files to unlink in parallel
     'min_size': 25,  #: Only check files this big or bigger.
 }
 CHUNK_SIZE = 2 ** 16  #: Size for chunked reads from file handles
 HEAD_SIZE = 2 ** 14  #: Limit how many bytes will be read to compare headers
+VERIFY_CHUNK_SIZE = 2 ** 20  #: Size for reads when verifying a single pair
+READAHEAD_SIZE = 2 ** 22  #: How far ahead to ask the OS to prefetch
+RESIDENCY_WINDOW = 2 ** 26  #: Furthest to look ahead for already-cached pages
+ARCHIVE_CACHE_SIZE = 16  #: Max. zip files to keep open for member reads
+
+#: Filename extensions which :option:`--archives` will look inside
+ZIP_EXTENSIONS = ('.zip', '.jar')
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+DIRECT_ALIGN = 4096  #: Offset and size alignment required by O_DIRECT
+UNLINK_BATCH = 64  #: Number of unlinks handed to a worker thread at once
 
 # {{{ General Helper Functions
 
@@ -63,6 +79,32 @@ try:
 except AttributeError:
     _stat = os.stat
 
+# Python 2.x doesn't expose these and other platforms use different values
+if hasattr(os, 'SEEK_DATA'):
+    SEEK_DATA, SEEK_HOLE = os.SEEK_DATA, os.SEEK_HOLE
+elif sys.platform.startswith('linux'):
+    SEEK_DATA, SEEK_HOLE = 3, 4
+else:
+    SEEK_DATA = SEEK_HOLE = None
+
+# Likewise for posix_fadvise(2), which we have to call via ctypes
+if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+    POSIX_FADV_SEQUENTIAL = os.POSIX_FADV_SEQUENTIAL
+    POSIX_FADV_WILLNEED = os.POSIX_FADV_WILLNEED
+    POSIX_FADV_DONTNEED = os.POSIX_FADV_DONTNEED
+elif sys.platform.startswith('linux'):
+    POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED = 2, 3, 4
+else:
+    POSIX_FADV_SEQUENTIAL = POSIX_FADV_WILLNEED = POSIX_FADV_DONTNEED = None
+O_DIRECT = getattr(os, 'O_DIRECT', None)
+
+_zero_digests = {}  # Memoized SHA1s of all-zero data for hashFile
+_libc = None  # Lazily loaded by libc()
+_fadvise_func = None  # Lazily loaded by fadvise()
+_mincore_funcs = None  # Lazily loaded by residency()
+_zip_cache = {}  # Open ZipFile objects used by ArchiveMember.open()
+_tar_digests = {}  # Results of single-pass tar hashing (See tarDigests)
+
 def multiglob_compile(globs, prefix=False):
     """Generate a single "A or B or C" regex from a list of shell globs.
 
@@ -86,7 +128,11 @@ def hashFile(handle, want_hex=False, limit=None, chunk_size=CHUNK_SIZE):
     """Generate a hash from a potentially long file.
     Digesting will obey :const:`CHUNK_SIZE` to conserve memory.
 
-    :param handle: A file-like object or path to hash from.
+    Files which turn out to be nothing but holes are hashed without reading
+    anything. (See :class:`~fastdupes.FileReader`)
+
+    :param handle: A file-like object or path (See
+        :func:`~fastdupes.openFile`) to hash from.
     :param want_hex: If ``True``, returned hash will be hex-encoded.
     :type want_hex: :class:`~__builtins__.bool`
 
@@ -106,12 +152,31 @@ def hashFile(handle, want_hex=False, limit=None, chunk_size=CHUNK_SIZE):
         in
     """
     fhash, read = hashlib.sha1(), 0
-    if isinstance(handle, basestring):
-        handle = file(handle, 'rb')
+    if isinstance(handle, ArchiveMember) and handle.crc is None:
+        digest = tarDigests(handle.archive, limit, chunk_size).get(
+            handle.info.offset)
+        if digest is None:
+            raise IOError(errno.EIO, "Could not read tar member", handle)
+        return want_hex and digest.encode('hex') or digest
+    elif isinstance(handle, basestring):
+        reader = openFile(handle)
+        try:
+            return hashFile(reader, want_hex, limit, chunk_size)
+        finally:
+            reader.close()
 
     if limit:
         chunk_size = min(chunk_size, limit)
 
+    # Files with no data at all can be hashed without reading them
+    extents = getattr(handle, 'extents', None)
+    if extents is not None and not extents and handle.pos == 0:
+        length = handle.size
+        if limit:
+            length = min(length, -(-limit // chunk_size) * chunk_size)
+        digest = zeroDigest(length)
+        return want_hex and digest.encode('hex') or digest
+
     # Chunked digest generation (conserve memory)
     for block in iter(lambda: handle.read(chunk_size), ''):
         fhash.update(block)
@@ -121,15 +186,428 @@ def hashFile(handle, want_hex=False, limit=None, chunk_size=CHUNK_SIZE):
 
     return want_hex and fhash.hexdigest() or fhash.digest()
 
+def zeroDigest(length):
+    """Return the SHA1 hash of ``length`` NUL bytes without touching the disk.
+
+    Results are memoized since sparse images tend to come in a few common
+    sizes.
+
+    :type length: :class:`~__builtins__.int`
+    :rtype: :class:`~__builtins__.str`
+    """
+    if length not in _zero_digests:
+        fhash, block = hashlib.sha1(), '\0' * CHUNK_SIZE
+        for _ in xrange(length // CHUNK_SIZE):
+            fhash.update(block)
+        fhash.update(block[:length % CHUNK_SIZE])
+        _zero_digests[length] = fhash.digest()
+    return _zero_digests[length]
+
+def parse_size(text):
+    """Parse a byte count with an optional ``K``, ``M``, ``G`` or ``T``
+    (binary) suffix.
+
+    :type text: :class:`~__builtins__.str`
+    :raises ValueError: ``text`` isn't a valid size.
+    :rtype: :class:`~__builtins__.int`
+    """
+    number = text.strip().upper().rstrip('B')
+    power = 'KMGT'.find(number[-1:]) + 1 if number else 0
+    if power:
+        number = number[:-1]
+
+    try:
+        return int(float(number) * 1024 ** power)
+    except ValueError:
+        raise ValueError("Invalid size: %s" % text)
+
+def fadvise(fileno, offset, length, advice):
+    """Call ``posix_fadvise(2)`` if the platform has it.
+
+    Advice is only a hint, so this silently does nothing when unsupported.
+
+    :param fileno: An open file descriptor.
+    :param offset: Start of the affected byte range.
+    :param length: Length of the affected byte range. (``0`` means "to EOF")
+    :param advice: One of the ``POSIX_FADV_*`` constants.
+    """
+    global _fadvise_func  # pylint: disable=global-statement
+    if advice is None:
+        return
+    elif hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fileno, offset, length, advice)
+        return
+    elif _fadvise_func is None:
+        try:
+            import ctypes
+            func = getattr(libc(), 'posix_fadvise64', None)
+            func = func or libc().posix_fadvise
+            func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                             ctypes.c_int]
+            _fadvise_func = func
+        except (AttributeError, ImportError):
+            _fadvise_func = False
+
+    if _fadvise_func:
+        _fadvise_func(fileno, offset, length, advice)
+
+def libc():
+    """Load the C library with :mod:`ctypes` on first use.
+
+    :returns: A :class:`ctypes.CDLL` or ``None`` if it can't be loaded.
+    """
+    global _libc  # pylint: disable=global-statement
+    if _libc is None:
+        try:
+            import ctypes, ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        except (ImportError, OSError):
+            _libc = False
+    return _libc or None
+
+def residency(fileno, offset, length):
+    """Use ``mincore(2)`` to find out which pages of a file are cached.
+
+    The range is mapped without being touched, so checking doesn't change
+    the answer.
+
+    :param fileno: An open file descriptor.
+    :param offset: Start of the range. (A multiple of :data:`mmap.PAGESIZE`)
+    :param length: Length of the range in bytes.
+
+    :returns: One byte per page, with the lowest bit set if the page is in
+        the page cache, or ``None`` if the OS can't tell us.
+    :rtype: :class:`~__builtins__.str`
+    """
+    global _mincore_funcs  # pylint: disable=global-statement
+    import ctypes, mmap
+    if _mincore_funcs is None:
+        try:
+            lib = libc()
+            map_func = getattr(lib, 'mmap64', None) or lib.mmap
+            map_func.restype = ctypes.c_void_p
+            map_func.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_int64]
+            lib.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                    ctypes.c_char_p]
+            lib.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            _mincore_funcs = (map_func, lib.mincore, lib.munmap)
+        except AttributeError:
+            _mincore_funcs = False
+    if not _mincore_funcs or length <= 0:
+        return None
+
+    map_func, mincore, munmap = _mincore_funcs
+    addr = map_func(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fileno,
+                    offset)
+    if addr in (None, ctypes.c_void_p(-1).value):
+        return None
+    try:
+        vec = ctypes.create_string_buffer(-(-length // mmap.PAGESIZE))
+        if mincore(addr, length, vec) != 0:
+            return None
+        return vec.raw
+    finally:
+        munmap(addr, length)
+
+class ReadPolicy(object):
+    """Process-wide settings for how :class:`~fastdupes.FileReader` reads.
+
+    :ivar drop_cache: Advise the OS to evict pages from the cache as soon as
+        they've been read so scanning doesn't push out other data. Only pages
+        which weren't already cached are evicted, and nothing is evicted
+        where :func:`~fastdupes.residency` can't tell which those are.
+    :ivar direct: Bypass the page cache entirely using ``O_DIRECT`` where
+        the filesystem supports it.
+    :ivar max_rate: Limit total reads to this many bytes per second.
+    """
+    def __init__(self, drop_cache=False, direct=False, max_rate=None):
+        self.drop_cache = drop_cache
+        self.direct = direct
+        self.max_rate = max_rate
+
+        self._lock = allocate_lock()
+        self._ready = 0
+
+    def throttle(self, nbytes):
+        """Sleep as long as necessary to keep reads within :attr:`max_rate`.
+
+        :param nbytes: How much was just read.
+        :type nbytes: :class:`~__builtins__.int`
+        """
+        if not self.max_rate:
+            return
+
+        with self._lock:
+            now = time.time()
+            self._ready = max(self._ready, now) + nbytes / float(self.max_rate)
+            delay = self._ready - now
+        if delay > 0:
+            time.sleep(delay)
+
+read_policy = ReadPolicy()
+
+def dataExtents(fileno, size):
+    """Map the allocated parts of a file using ``SEEK_DATA``/``SEEK_HOLE``.
+
+    :param fileno: An open file descriptor. Its offset will be clobbered.
+    :type fileno: :class:`~__builtins__.int`
+
+    :param size: The size of the file in bytes.
+    :type size: :class:`~__builtins__.int`
+
+    :returns: A list of ``(start, end)`` byte ranges which may contain data or
+        ``None`` if the OS or filesystem can't tell us.
+    :rtype: :class:`~__builtins__.list`
+    """
+    if SEEK_DATA is None:
+        return None
+
+    extents, pos = [], 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fileno, pos, SEEK_DATA)
+            except OSError, err:
+                if err.errno == errno.ENXIO:
+                    break  # Nothing but holes from here to EOF
+                raise
+            pos = min(os.lseek(fileno, start, SEEK_HOLE), size)
+            extents.append((start, pos))
+    except OSError:
+        return None
+    return extents
+
+class FileReader(object):
+    """Read-only file wrapper which skips reading unallocated ranges.
+
+    Holes found by :func:`~fastdupes.dataExtents` are returned as NUL bytes
+    without any I/O, so sparse and preallocated files cost only as much as
+    the data they actually contain. Reads always return the full amount
+    requested (short of EOF) so that chunks from different readers can be
+    compared directly.
+
+    All actual reads also obey the settings in :data:`read_policy`.
+
+    :param path: The file to open.
+    :type path: :class:`~__builtins__.str`
+
+    :ivar size: The size of the file when it was opened.
+    :ivar pos: The current offset within the file.
+    :ivar extents: A :class:`~collections.deque` of the remaining
+        ``(start, end)`` data ranges (empty if the file is nothing but holes)
+        or ``None`` if everything is to be read normally.
+    """
+    def __init__(self, path):
+        self.direct, self.pos, self.streamed, self.advised = False, 0, 0, 0
+        self._buffer = None
+        self._resident, self._resident_start = '', 0
+
+        if read_policy.direct and O_DIRECT:
+            import io
+            try:
+                self.fobj = io.FileIO(os.open(path, os.O_RDONLY | O_DIRECT))
+                self.direct = True
+            except OSError:
+                pass  # Not supported by this filesystem. (eg. tmpfs)
+        if not self.direct:
+            self.fobj = open(path, 'rb')
+
+        filestat = os.fstat(self.fobj.fileno())
+        self.size, self.extents = filestat.st_size, None
+
+        # Probing costs a couple of syscalls, so skip files too small to
+        # benefit. (st_blocks is always in 512-byte units)
+        if self.size > CHUNK_SIZE or (self.size and
+                getattr(filestat, 'st_blocks', 1) == 0):
+            extents = dataExtents(self.fobj.fileno(), self.size)
+            self.fobj.seek(0)
+            if extents is not None and extents != [(0, self.size)]:
+                from collections import deque
+                self.extents = deque(extents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the underlying file handle.
+
+        With :attr:`ReadPolicy.drop_cache`, anything which readahead brought
+        in past the last read is evicted first.
+        """
+        if read_policy.drop_cache and self._resident and not self.fobj.closed:
+            import mmap
+            self._dropPages(self._resident_start, self._resident_start +
+                            len(self._resident) * mmap.PAGESIZE)
+        self.fobj.close()
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes, skipping over holes.
+
+        :param size: Number of bytes to read. Negative means "until EOF".
+        :type size: :class:`~__builtins__.int`
+
+        :rtype: :class:`~__builtins__.str`
+        """
+        if self.extents is None:
+            data = self._read(size)
+            self.pos += len(data)
+            return data
+
+        if size < 0:
+            size = self.size
+        size = min(size, self.size - self.pos)
+
+        pieces = []
+        while size > 0:
+            while self.extents and self.extents[0][1] <= self.pos:
+                self.extents.popleft()
+
+            if not self.extents or self.pos < self.extents[0][0]:
+                hole_end = self.extents[0][0] if self.extents else self.size
+                length = min(size, hole_end - self.pos)
+                pieces.append('\0' * length)
+            else:
+                data = self._read(min(size, self.extents[0][1] - self.pos))
+                if not data:
+                    break  # Truncated while we were reading it
+                length = len(data)
+                pieces.append(data)
+
+            self.pos += length
+            size -= length
+        return ''.join(pieces)
+
+    def _read(self, size):
+        """Read from :attr:`pos` without skipping holes, obeying
+        :data:`read_policy`."""
+        start = self.pos
+        if self.direct:
+            data = self._readDirect(size)
+        else:
+            if self.fobj.tell() != start:
+                self.fobj.seek(start)
+            if read_policy.drop_cache:
+                end = self.size if size < 0 else min(start + size, self.size)
+                self._checkResidency(start, end)
+            data = self.fobj.read(size)
+            self._advise(start, start + len(data))
+
+        progress.bytes += len(data)
+        read_policy.throttle(len(data))
+        return data
+
+    def _readDirect(self, size):
+        """Perform an ``O_DIRECT`` read by rounding out to aligned offsets and
+        reading into a page-aligned buffer."""
+        if size < 0:
+            size = max(self.size - self.pos, 0)
+        start = self.pos - self.pos % DIRECT_ALIGN
+        length = -(-(self.pos + size - start) // DIRECT_ALIGN) * DIRECT_ALIGN
+        if not length:
+            return ''
+
+        # Anonymous mmaps are always page-aligned
+        if self._buffer is None or len(self._buffer) != length:
+            import mmap
+            self._buffer = mmap.mmap(-1, length)
+
+        self.fobj.seek(start)
+        got = self.fobj.readinto(self._buffer) or 0
+        return self._buffer[self.pos - start:min(got, self.pos - start + size)]
+
+    def _checkResidency(self, start, end):
+        """Before reading ``start`` to ``end``, note which pages were already
+        cached so that :meth:`_dropPages` leaves them alone.
+
+        The kernel's own readahead window grows as a file is streamed, so
+        pages are checked further ahead the more has been read (up to
+        :data:`RESIDENCY_WINDOW`) to make sure neither it nor our
+        ``WILLNEED`` hints get there first.
+        """
+        import mmap
+        if self._resident is None:
+            return  # Residency can't be checked for this file
+        page = mmap.PAGESIZE
+        ahead = min(max(2 * READAHEAD_SIZE, 4 * self.streamed),
+                    RESIDENCY_WINDOW)
+        first = start - start % page
+        known_end = self._resident_start + len(self._resident) * page
+        if self._resident_start <= first < known_end:
+            if end + ahead // 2 <= known_end or known_end >= self.size:
+                return
+            kept = self._resident[(first - self._resident_start) // page:]
+        else:
+            kept, known_end = '', first
+
+        last = min(end + ahead, self.size)
+        vec = residency(self.fobj.fileno(), known_end, last - known_end)
+        if vec is None and last > known_end:
+            self._resident = None
+        else:
+            self._resident, self._resident_start = kept + (vec or ''), first
+
+    def _dropPages(self, start, end):
+        """Evict the pages from ``start`` to ``end`` which this reader
+        brought into the page cache."""
+        import mmap
+        if not self._resident:
+            return
+        page, base = mmap.PAGESIZE, self._resident_start
+        first = start - start % page
+        if end >= self.size:
+            end = -(-end // page) * page  # Include the partial last page
+        vec = self._resident[(first - base) // page:-(-(end - base) // page)]
+
+        # A partly-read last page is left for the next read to drop
+        for match in re.finditer('\x00+', vec):
+            offset = first + match.start() * page
+            length = min(first + match.end() * page, end) - offset
+            if length > 0:
+                fadvise(self.fobj.fileno(), offset, length,
+                        POSIX_FADV_DONTNEED)
+
+    def _advise(self, start, end):
+        """Tell the OS what we just read and what we'll read next.
+
+        Readahead hints are held back until the file has been streamed for a
+        couple of chunks so that header hashing doesn't trigger them.
+        """
+        fileno = self.fobj.fileno()
+        if read_policy.drop_cache and end > start:
+            self._dropPages(start, end)
+
+        self.streamed += end - start
+        if self.streamed < 2 * CHUNK_SIZE or end >= self.size:
+            return
+        elif not self.advised:
+            fadvise(fileno, 0, 0, POSIX_FADV_SEQUENTIAL)
+        if end + READAHEAD_SIZE // 2 > self.advised:
+            fadvise(fileno, end, READAHEAD_SIZE, POSIX_FADV_WILLNEED)
+            self.advised = end + READAHEAD_SIZE
+
 class OverWriter(object):  # pylint: disable=too-few-public-methods
-    """Output helper for handling overdrawing the previous line cleanly."""
+    """Output helper for handling overdrawing the previous line cleanly.
+
+    When not attached to a terminal, only lines ending with a newline are
+    written so logs don't fill up with progress messages.
+    """
     def __init__(self, fobj):
         self.max_len = 0
         self.fobj = fobj
+        self._isatty = None
 
-        self.isatty = False
-        if hasattr(self.fobj, 'fileno'):
-            self.isatty = os.isatty(self.fobj.fileno())
+    @property
+    def isatty(self):
+        """Whether output is going to a terminal. (Checked on first use)"""
+        if self._isatty is None:
+            self._isatty = (hasattr(self.fobj, 'fileno') and
+                            os.isatty(self.fobj.fileno()))
+        return self._isatty
 
     def write(self, text, newline=False):
         """Use ``\\r`` to overdraw the current line with the given text.
@@ -143,7 +621,8 @@ class OverWriter(object):  # pylint: disable=too-few-public-methods
         :type newline: :class:`~__builtins__.bool`
         """
         if not self.isatty:
-            self.fobj.write('%s\n' % text)
+            if newline:
+                self.fobj.write('%s\n' % text)
             return
 
         msg_len = len(text)
@@ -154,15 +633,329 @@ class OverWriter(object):  # pylint: disable=too-few-public-methods
             self.fobj.write('\n')
             self.max_len = 0
 
+def format_size(nbytes):
+    """Format a byte count for humans using binary prefixes.
+
+    :type nbytes: :class:`~__builtins__.int`
+    :rtype: :class:`~__builtins__.str`
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = 'TiB'
+    return "%.1f %s" % (nbytes, unit)
+
+class Progress(object):
+    """Rate-limited progress display for the processing pipeline.
+
+    Hot loops only increment :attr:`files` and :attr:`bytes`. A background
+    thread (only started when output goes to a terminal) reads them every
+    :attr:`interval` seconds and renders the status line.
+
+    .. note:: Counters may be bumped from several threads at once without
+        locking. Occasionally losing an increment is harmless for display.
+
+    :param output: Where to render progress.
+    :type output: :class:`~fastdupes.OverWriter`
+
+    :ivar stage: Description of what is currently being done.
+    :ivar files: Files processed so far in the current stage.
+    :ivar bytes: Bytes read so far in the current stage.
+    :ivar total: Files expected in the current stage or ``0`` if unknown.
+    """
+    def __init__(self, output, interval=0.5):
+        self.output, self.interval = output, interval
+        self.stage, self.files, self.bytes, self.total = '', 0, 0, 0
+        self._started, self._thread, self._lock = 0, None, allocate_lock()
+
+    def start(self, stage, total=0):
+        """Reset the counters and begin displaying a new stage.
+
+        :param stage: See :attr:`stage`
+        :param total: See :attr:`total`
+        """
+        self.files, self.bytes, self.total = 0, 0, total
+        self._started, self.stage = time.time(), stage
+
+        if self._thread is None and self.output.isatty:
+            import threading
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def finish(self, text):
+        """End the current stage, replacing the status line with ``text``.
+
+        :type text: :class:`~__builtins__.str`
+        """
+        with self._lock:
+            self.stage = ''
+            self.output.write(text, newline=True)
+
+    def render(self):
+        """Build the status line for the current counter values.
+
+        :rtype: :class:`~__builtins__.str`
+        """
+        elapsed = max(time.time() - self._started, 0.001)
+        files, nbytes, total = self.files, self.bytes, self.total
+
+        text = "%s... (%d%s files" % (self.stage, files,
+                                      total and "/%d" % total or '')
+        if nbytes:
+            text += ", %s/s" % format_size(nbytes / elapsed)
+        if total and files:
+            eta = int(elapsed * (total - files) / files)
+            text += ", ETA %d:%02d" % divmod(eta, 60)
+        return text + ")"
+
+    def _run(self):
+        """Background loop which redraws the status line."""
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if self.stage:
+                    self.output.write(self.render())
+
 out = OverWriter(sys.stderr)
+progress = Progress(out)
+
+# }}}
+# {{{ Archive Support
+
+class ArchiveMember(str):
+    """A virtual path (``ARCHIVE!/MEMBER``) to a file inside an archive.
+
+    Since this is a :class:`~__builtins__.str`, it passes through grouping and
+    output like any other path while carrying the metadata needed to read
+    the member without extracting it.
+
+    :param archive: Absolute path to the containing zip or tar file.
+    :param name: Path of the member within the archive. (Stored as UTF-8 if
+        given as :class:`~__builtins__.unicode`)
+    :param size: Uncompressed size of the member.
+    :param crc: CRC32 from a zip central directory. (``None`` for tar files)
+    :param info: The :class:`zipfile.ZipInfo` or :class:`tarfile.TarInfo`.
+    """
+    def __new__(cls, archive, name, size, crc=None, info=None):
+        # zipfile decodes names of members flagged as UTF-8
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self = str.__new__(cls, '%s!/%s' % (archive, name))
+        self.archive, self.name, self.size = archive, name, size
+        self.crc, self.info = crc, info
+        return self
+
+    def open(self):
+        """Open the member for streaming decompression.
+
+        :returns: A :class:`~fastdupes.ArchiveReader` which the caller must
+            close.
+        :raises IOError: The archive is unreadable, corrupt or encrypted.
+        """
+        errors = archiveErrors()
+        try:
+            if self.crc is None:
+                import tarfile
+                tfile = tarfile.open(self.archive)
+                try:
+                    return ArchiveReader(self, tfile.extractfile(self.info),
+                                         errors, tfile)
+                except:
+                    tfile.close()
+                    raise
+
+            if self.archive not in _zip_cache:
+                import zipfile
+                if len(_zip_cache) >= ARCHIVE_CACHE_SIZE:
+                    # Safe even with members still open since ZipFile.open()
+                    # gives each one its own file handle
+                    for zfile in _zip_cache.values():
+                        zfile.close()
+                    _zip_cache.clear()
+                _zip_cache[self.archive] = zipfile.ZipFile(self.archive)
+            zfile = _zip_cache[self.archive]
+            return ArchiveReader(self, zfile.open(self.info), errors)
+        except errors, err:
+            raise IOError(errno.EIO, str(err), self)
+
+class ArchiveReader(object):
+    """Wrapper for an open archive member which reports corrupt, truncated or
+    encrypted data as :class:`~__builtins__.IOError`, like any other
+    unreadable file.
+
+    Decompressed data is counted towards progress and
+    :attr:`ReadPolicy.max_rate`. (Which, since it's never smaller than what
+    was actually read from disk, keeps the real read rate under the cap)
+    The cache-related :data:`read_policy` settings don't apply since
+    :mod:`zipfile` and :mod:`tarfile` do their own reading.
+
+    :param member: The :class:`~fastdupes.ArchiveMember` being read.
+    :param fobj: The file-like object returned by :mod:`zipfile` or
+        :mod:`tarfile`.
+    :param errors: See :func:`~fastdupes.archiveErrors`
+    :param owner: If provided, an archive object (eg. a
+        :class:`tarfile.TarFile`) to be closed along with the member.
+    """
+    def __init__(self, member, fobj, errors, owner=None):
+        self.member, self.fobj, self.errors = member, fobj, errors
+        self.owner = owner
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes of decompressed data.
+
+        :raises IOError: The member's data is corrupt or truncated.
+        """
+        try:
+            data = self.fobj.read(size)
+        except self.errors, err:
+            raise IOError(errno.EIO, str(err), self.member)
+
+        progress.bytes += len(data)
+        read_policy.throttle(len(data))
+        return data
+
+    def close(self):
+        """Close the underlying member (and archive, if owned)."""
+        self.fobj.close()
+        if self.owner:
+            self.owner.close()
+
+def tarDigests(archive, limit=None, chunk_size=CHUNK_SIZE):
+    """Hash every regular file in a tar archive in a single streaming pass.
+
+    Reading members one at a time would mean re-opening the archive for each
+    of them and, for compressed archives, decompressing everything before
+    each one again. Instead, the first request for a given archive and
+    ``limit`` hashes all of its members and later ones are answered from
+    :data:`_tar_digests`.
+
+    :param archive: Absolute path to the tar file.
+    :type archive: :class:`~__builtins__.str`
+
+    :param limit: See :func:`~fastdupes.hashFile`
+    :param chunk_size: See :func:`~fastdupes.hashFile`
+
+    :returns: A dict mapping :attr:`tarfile.TarInfo.offset` to SHA1 digests.
+        Members which couldn't be read (eg. after a corrupt block) are left
+        out.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    key = (archive, limit, chunk_size)
+    if key not in _tar_digests:
+        import tarfile
+        errors = archiveErrors()
+        digests = _tar_digests[key] = {}
+        try:
+            tfile = tarfile.open(archive, 'r|*')
+            try:
+                for info in tfile:
+                    if not info.isfile():
+                        continue
+                    reader = ArchiveReader('%s!/%s' % (archive, info.name),
+                                           tfile.extractfile(info), errors)
+                    digests[info.offset] = hashFile(reader, limit=limit,
+                                                    chunk_size=chunk_size)
+            finally:
+                tfile.close()
+        except errors + (IOError,):
+            pass  # Keep whatever was hashed before the damage
+    return _tar_digests[key]
+
+def archiveErrors():
+    """Exceptions which :mod:`zipfile` and :mod:`tarfile` raise for archives
+    which are corrupt (eg. a bad CRC), truncated or encrypted.
+
+    :rtype: :class:`~__builtins__.tuple`
+    """
+    import tarfile, zipfile, zlib
+    return (EOFError, RuntimeError, tarfile.TarError, zipfile.BadZipfile,
+            zlib.error)
+
+def listArchive(path):
+    """List the regular files inside a zip or tar archive.
+
+    Only the archive's index is read. (For compressed tar files, this means
+    decompressing the whole thing once without keeping the output.)
+
+    :param path: Absolute path to a file which may be an archive.
+    :type path: :class:`~__builtins__.str`
+
+    :returns: An empty list if ``path`` isn't a readable archive.
+    :rtype: :class:`~__builtins__.list` of :class:`~fastdupes.ArchiveMember`
+    """
+    lower_path = path.lower()
+    if lower_path.endswith(ZIP_EXTENSIONS):
+        import zipfile
+        try:
+            zfile = zipfile.ZipFile(path)
+        except (IOError, zipfile.BadZipfile):
+            return []
+        try:
+            # Bit 0 of the flags marks encrypted members, which can't be read
+            return [ArchiveMember(path, x.filename, x.file_size, x.CRC, x)
+                    for x in zfile.infolist()
+                    if not x.filename.endswith('/') and not x.flag_bits & 1]
+        finally:
+            zfile.close()
+    elif lower_path.endswith(TAR_EXTENSIONS):
+        import tarfile
+        try:
+            tfile = tarfile.open(path)
+            try:
+                return [ArchiveMember(path, x.name, x.size, None, x)
+                        for x in tfile.getmembers() if x.isfile()]
+            finally:
+                tfile.close()
+        except (EOFError, IOError, tarfile.TarError):
+            return []
+    return []
+
+def openFile(path):
+    """Open a path from :func:`~fastdupes.getPaths` for reading.
+
+    :param path: A real path or an :class:`~fastdupes.ArchiveMember`
+    :returns: A file-like object which the caller must close.
+    """
+    if isinstance(path, ArchiveMember):
+        return path.open()
+    return FileReader(path)
 
 # }}}
 # {{{ Processing Pipeline
 
-def getPaths(roots, ignores=None):
+def collapseRoots(roots):
+    """Resolve a list of paths and drop any which are exact duplicates of
+    earlier entries.
+
+    Nested roots are kept since the user may have named them precisely
+    because walking the parent won't reach them (eg. they're excluded or on
+    another filesystem). :func:`~fastdupes.getPaths` makes sure that no
+    directory is walked twice.
+
+    :param roots: Relative or absolute paths to files or folders.
+    :type roots: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+
+    :returns: Unique real paths, in the order given.
+    :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+    """
+    real = []
+    for root in roots:
+        root = os.path.realpath(root)
+        if root not in real:
+            real.append(root)
+    return real
+
+def getPaths(roots, ignores=None, archives=False, one_file_system=False,
+             follow_symlinks=False):
     """
     Recursively walk a set of paths and return a listing of contained files.
 
+    Each directory is only walked once, even if reached through overlapping
+    roots, bind mounts, or (with ``follow_symlinks``) symlink loops.
+
     :param roots: Relative or absolute paths to files or folders.
     :type roots: :class:`~__builtins__.list` of :class:`~__builtins__.str`
 
@@ -170,6 +963,19 @@ def getPaths(roots, ignores=None):
         omit from results
     :type ignores: :class:`~__builtins__.list` of :class:`~__builtins__.str`
 
+    :param archives: If ``True``, the members of any zip or tar archives
+        found will be listed too. (See :func:`~fastdupes.listArchive`)
+    :type archives: :class:`~__builtins__.bool`
+
+    :param one_file_system: If ``True``, don't descend into directories on
+        other filesystems than the root they were found under.
+    :type one_file_system: :class:`~__builtins__.bool`
+
+    :param follow_symlinks: If ``True``, descend into symlinked directories.
+        (Symlinks to files are still skipped by
+        :func:`~fastdupes.sizeClassifier`)
+    :type follow_symlinks: :class:`~__builtins__.bool`
+
     :returns: Absolute paths to only files.
     :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.str`
 
@@ -177,45 +983,76 @@ def getPaths(roots, ignores=None):
        filename is a fairly significant percentage of the time taken according
        to the profiler.
     """
-    paths, count, ignores = [], 0, ignores or []
+    paths, ignores, visited = [], ignores or [], set()
+    dir_stat = os.stat if follow_symlinks else _stat
 
     # Prepare the ignores list for most efficient use
     ignore_re = multiglob_compile(ignores, prefix=False)
+    progress.start("Gathering file paths to compare")
 
+    # For safety, only use absolute, real paths.
+    roots = collapseRoots(roots)
+    named = set(x for x in roots if os.path.isfile(x))
     for root in roots:
-        # For safety, only use absolute, real paths.
-        root = os.path.realpath(root)
-
         # Handle directly-referenced filenames properly
         # (And override ignores to "do as I mean, not as I say")
-        if os.path.isfile(root):
+        if root in named:
             paths.append(root)
+            if archives:
+                paths.extend(listArchive(root))
             continue
 
-        for fldr in os.walk(root):
-            out.write("Gathering file paths to compare... (%d files examined)"
-                      % count)
+        try:
+            root_stat = os.stat(root)
+        except OSError:
+            continue
+        if (root_stat.st_dev, root_stat.st_ino) in visited:
+            continue  # Bind mount of a root we've already walked
+        visited.add((root_stat.st_dev, root_stat.st_ino))
 
-            # Don't even descend into IGNOREd directories.
+        for fldr in os.walk(root, followlinks=follow_symlinks):
+            subdirs = []
             for subdir in fldr[1]:
                 dirpath = os.path.join(fldr[0], subdir)
+
+                # Don't even descend into IGNOREd directories.
                 if ignore_re.match(dirpath):
-                    fldr[1].remove(subdir)
+                    continue
+
+                try:
+                    substat = dir_stat(dirpath)
+                except OSError:
+                    continue
+                if stat.S_ISLNK(substat.st_mode):
+                    continue  # os.walk won't follow it anyway
+                elif one_file_system and substat.st_dev != root_stat.st_dev:
+                    continue
+
+                # Catches symlink loops and bind mounts
+                dir_id = (substat.st_dev, substat.st_ino)
+                if dir_id not in visited:
+                    visited.add(dir_id)
+                    subdirs.append(subdir)
+            fldr[1][:] = subdirs
 
             for filename in fldr[2]:
                 filepath = os.path.join(fldr[0], filename)
-                if ignore_re.match(filepath):
-                    continue  # Skip IGNOREd files.
+                if ignore_re.match(filepath) or filepath in named:
+                    continue  # Skip IGNOREd (or already listed) files.
 
                 paths.append(filepath)
-                count += 1
+                progress.files += 1
+
+                if archives:
+                    paths.extend(x for x in listArchive(filepath)
+                                 if not ignore_re.match(x))
 
-    out.write("Found %s files to be compared for duplication." % (len(paths)),
-              newline=True)
+    progress.finish("Found %s files to be compared for duplication."
+                    % len(paths))
     return paths
 
 def groupBy(groups_in, classifier, fun_desc='?', keep_uniques=False,
-            *args, **kwargs):
+            overlapping=False, *args, **kwargs):
     """Subdivide groups of paths according to a function.
 
     :param groups_in: Grouped sets of paths.
@@ -229,8 +1066,15 @@ def groupBy(groups_in, classifier, fun_desc='?', keep_uniques=False,
     :type fun_desc: :class:`~__builtins__.str`
 
     :param keep_uniques: If ``False``, discard groups with only one member.
+        (This also allows classifiers made by :func:`~fastdupes.groupify` to
+        be run in bulk using :func:`~fastdupes.batchGroup`.)
     :type keep_uniques: :class:`~__builtins__.bool`
 
+    :param overlapping: Set this if a path may appear in more than one input
+        group (eg. after :func:`~fastdupes.crcClassifier`) so that each path
+        is still only classified once.
+    :type overlapping: :class:`~__builtins__.bool`
+
 
     :returns: A dict mapping classifier keys to groups of matches.
     :rtype: :class:`~__builtins__.dict`
@@ -240,26 +1084,42 @@ def groupBy(groups_in, classifier, fun_desc='?', keep_uniques=False,
         ``groups`` as extra protection against accidentally counting a given
         file twice. (Complimentary to use of :func:`os.path.realpath` in
         :func:`~fastdupes.getPaths`)
-
-    .. todo:: Find some way to bring back the file-by-file status text
     """
-    groups, count, group_count = {}, 0, len(groups_in)
-    for pos, paths in enumerate(groups_in.values()):
-        out.write("Subdividing group %d of %d by %s... (%d files examined, %d "
-                  "in current group)" % (
-                      pos + 1, group_count, fun_desc, count, len(paths)
-                  ))
-
-        for key, group in classifier(paths, *args, **kwargs).items():
-            groups.setdefault(key, set()).update(group)
-            count += len(group)
+    groups, count = {}, 0
+    progress.start("Subdividing %d groups by %s" % (len(groups_in), fun_desc),
+                   sum(len(x) for x in groups_in.values()))
+
+    key_function = getattr(classifier, 'key_function', None)
+    if key_function and not keep_uniques:
+        # Skip the per-file dict juggling and group the whole column at once
+        if overlapping:
+            groups_in = {None: set().union(*groups_in.values())}
+
+        paths, keys = [], []
+        for group in groups_in.values():
+            for path in group:
+                key = key_function(path, *args, **kwargs)
+                if key is not None:
+                    paths.append(path)
+                    keys.append(key)
+                progress.files += 1
+
+        count = len(paths)
+        groups = batchGroup(keys, paths)
+    else:
+        seen = set()
+        for paths in groups_in.values():
+            for key, group in classifier(paths, *args, **kwargs).items():
+                groups.setdefault(key, set()).update(group)
+                seen.update(group)
+        count = len(seen)
 
     if not keep_uniques:
         # Return only the groups with more than one file.
         groups = dict([(x, groups[x]) for x in groups if len(groups[x]) > 1])
 
-    out.write("Found %s sets of files with identical %s. (%d files examined)"
-              % (len(groups), fun_desc, count), newline=True)
+    progress.finish("Found %s sets of files with identical %s. (%d files "
+                    "examined)" % (len(groups), fun_desc, count))
     return groups
 
 def groupify(function):
@@ -284,10 +1144,65 @@ def groupify(function):
             key = function(path, *args, **kwargs)
             if key is not None:
                 groups.setdefault(key, set()).add(path)
+            progress.files += 1
 
         return groups
+    wrapper.key_function = function
     return wrapper
 
+def batchGroup(keys, values):
+    """Group a column of values by a parallel column of keys in bulk.
+
+    Uses NumPy's ``argsort`` to find runs of equal keys when available.
+    Otherwise, a single dict pass remembers the first value seen for each key
+    and only builds a :class:`~__builtins__.set` for keys which turn up
+    again, which is much cheaper than one set per key when, as usual, most
+    keys are unique.
+
+    :param keys: Integers or equal-length byte strings (eg. digests)
+    :type keys: :class:`~__builtins__.list`
+
+    :param values: The paths the keys belong to.
+    :type values: :class:`~__builtins__.list`
+
+    :returns: A dict mapping each key which occurs more than once to the set
+        of its values.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    if not keys:
+        return {}
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        column = numpy.array(keys)
+        order = column.argsort(kind='mergesort')
+        column = column[order]
+
+        starts = numpy.flatnonzero(column[1:] != column[:-1]) + 1
+        starts = numpy.concatenate(([0], starts))
+        ends = numpy.append(starts[1:], len(keys))
+        multi = (ends - starts) > 1
+
+        ordered = [values[x] for x in order.tolist()]
+        return dict((keys[order[start]], set(ordered[start:end]))
+                    for start, end in zip(starts[multi].tolist(),
+                                          ends[multi].tolist()))
+
+    from itertools import izip
+    first, groups = {}, {}
+    for key, value in izip(keys, values):
+        seen = first.setdefault(key, value)
+        if seen is not value:
+            if key in groups:
+                groups[key].add(value)
+            else:
+                groups[key] = set((seen, value))
+    return groups
+
 @groupify
 def sizeClassifier(path, min_size=DEFAULTS['min_size']):
     """Sort a file into a group based on on-disk size.
@@ -303,6 +1218,9 @@ def sizeClassifier(path, min_size=DEFAULTS['min_size']):
         calls. It's a fairly significant percentage of the time taken according
         to the profiler.
     """
+    if isinstance(path, ArchiveMember):
+        return path.size if path.size >= min_size else None
+
     filestat = _stat(path)
     if stat.S_ISLNK(filestat.st_mode):
         return  # Skip symlinks.
@@ -324,7 +1242,84 @@ def hashClassifier(path, limit=HEAD_SIZE):
 
     :returns: See :func:`fastdupes.groupify`
     """
-    return hashFile(path, limit=limit)
+    try:
+        return hashFile(path, limit=limit)
+    except IOError:
+        if not isinstance(path, ArchiveMember):
+            raise
+        return None  # Corrupt archive member. Leave it out.
+
+def crcClassifier(paths):
+    """Subdivide a group of zip members using the CRC32s from their archives'
+    central directories, without decompressing anything.
+
+    Other files in the group have no stored CRC and computing one would mean
+    reading them, so they are added to every subgroup and left for the later
+    stages to sort out. (The next stage is run with ``overlapping`` set, so
+    nothing is read twice. See :func:`~fastdupes.groupBy`)
+
+    :param paths: A group of paths with identical sizes.
+    :type paths: iterable
+
+    :returns: A dict mapping keys to groups of paths.
+    """
+    progress.files += len(paths)
+    groups, others = {}, set()
+    for path in paths:
+        if getattr(path, 'crc', None) is None:
+            others.add(path)
+        else:
+            groups.setdefault((path.size, path.crc), set()).add(path)
+
+    if not groups:
+        # Any key which can't collide with one from another group will do
+        return {(None, min(paths)): paths}
+
+    for group in groups.values():
+        group.update(others)
+    return groups
+
+def splitHoles(groups):
+    """Set aside files which are nothing but holes so they needn't be read
+    or hashed.
+
+    Such files are identical to each other whenever their sizes match, so
+    they're grouped under ``('holes', size)`` keys without computing
+    anything. A file only stays behind for the final comparison (where
+    :func:`~fastdupes.zeroDigest` stands in for reading it) if its group
+    also holds a file with real data and the same size, which could match.
+
+    :param groups: A dict mapping keys to groups of paths.
+    :type groups: :class:`~__builtins__.dict`
+
+    :returns: The groups of all-hole files and the groups which still need
+        comparing.
+    :rtype: ``(dict, dict)``
+    """
+    holes, rest = {}, {}
+    for key, group in groups.items():
+        sparse, dense_sizes = {}, set()
+        for path in group:
+            if isinstance(path, ArchiveMember):
+                continue
+            try:
+                with FileReader(path) as reader:
+                    if reader.extents is not None and not reader.extents:
+                        sparse.setdefault(reader.size, set()).add(path)
+                    else:
+                        dense_sizes.add(reader.size)
+            except (IOError, OSError):
+                pass  # Leave it for the final stage to deal with
+
+        group = set(group)
+        for size, paths in sparse.items():
+            if size not in dense_sizes:
+                holes.setdefault(('holes', size), set()).update(paths)
+                group -= paths
+        if len(group) > 1:
+            rest[key] = group
+
+    return dict((x, y) for x, y in holes.items() if len(y) > 1), rest
 
 def groupByContent(paths):
     """Byte-for-byte comparison on an arbitrary number of files in parallel.
@@ -357,7 +1352,7 @@ def groupByContent(paths):
     hList = []
     for path in paths:
         try:
-            hList.append((path, open(path, 'rb'), ''))
+            hList.append((path, openFile(path), ''))
         except IOError:
             pass  # TODO: Verbose-mode output here.
     handles.append(hList)
@@ -369,6 +1364,7 @@ def groupByContent(paths):
         # Add the results to the top-level lists.
         handles.extend(more)
         results.extend(done)
+        progress.files += sum(len(x) for x in done)
 
     # Keep the same API as the others.
     return dict((x[0], x) for x in results)
@@ -393,8 +1389,12 @@ def compareChunks(handles, chunk_size=CHUNK_SIZE):
     .. attention:: File handles will be closed when no longer needed
     .. todo:: Discard chunk contents immediately once they're no longer needed
     """
-    chunks = [(path, fh, fh.read(chunk_size)) for path, fh, _ in handles]
-    more, done = [], []
+    chunks, more, done = [], [], []
+    for path, fh, _ in handles:
+        try:
+            chunks.append((path, fh, fh.read(chunk_size)))
+        except IOError:
+            fh.close()  # Unreadable (eg. a corrupt archive member). Drop it.
 
     # While there are combinations not yet tried...
     while chunks:
@@ -416,6 +1416,492 @@ def compareChunks(handles, chunk_size=CHUNK_SIZE):
 
     return more, done
 
+def compareFiles(path_a, path_b, chunk_size=VERIFY_CHUNK_SIZE):
+    """Byte-for-byte comparison of exactly two files.
+
+    Unlike :func:`~fastdupes.groupByContent`, this only ever holds two
+    handles open and uses large reads, so each file is streamed sequentially
+    with minimal seeking. It's meant for double-checking a file against its
+    keeper right before deletion.
+
+    :param path_a: A file to compare.
+    :param path_b: Another file to compare.
+    :type path_a: :class:`~__builtins__.str`
+    :type path_b: :class:`~__builtins__.str`
+
+    :param chunk_size: Size of :meth:`~__builtins__.file.read` operations
+        in bytes.
+    :type chunk_size: :class:`~__builtins__.int`
+
+    :returns: ``True`` if both files have identical contents.
+    :rtype: :class:`~__builtins__.bool`
+    """
+    with FileReader(path_a) as fobj_a:
+        with FileReader(path_b) as fobj_b:
+            while True:
+                block = fobj_a.read(chunk_size)
+                if block != fobj_b.read(chunk_size):
+                    return False
+                elif not block:
+                    return True
+
+# }}}
+# {{{ Persistent Store
+
+def open_db(path):
+    """Open (and, if necessary, create) a SQLite store of scan results.
+
+    The store holds one row per file which survived the size filter, keyed
+    by absolute path (byte-for-byte, like :class:`~fastdupes.AuditLog`),
+    along with the size, modification time and inode seen when it was
+    scanned. Full-content digests are filled in for every file which reached
+    the final comparison stage and are otherwise left ``NULL`` until a query
+    needs them.
+
+    :param path: Path to the SQLite database file.
+    :type path: :class:`~__builtins__.str`
+
+    :rtype: :class:`sqlite3.Connection`
+    """
+    import sqlite3
+    conn = sqlite3.connect(path)
+    # Paths are bytes which needn't be valid in any encoding, so store and
+    # return them untouched rather than as unicode.
+    conn.text_factory = str
+    conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                 "path TEXT PRIMARY KEY, size INTEGER NOT NULL, digest BLOB, "
+                 "mtime REAL, ino INTEGER)")
+
+    # Stores written before mtime/ino were tracked get the columns added;
+    # their rows read as stale and are re-checked on first use.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    for name, kind in (('mtime', 'REAL'), ('ino', 'INTEGER')):
+        if name not in columns:
+            conn.execute("ALTER TABLE files ADD COLUMN %s %s" % (name, kind))
+
+    conn.execute("CREATE INDEX IF NOT EXISTS files_size_digest "
+                 "ON files (size, digest)")
+    return conn
+
+def db_record_sizes(conn, groups):
+    """Record the output of the size stage, resetting any stored digests.
+
+    Archive members and files which vanished since the walk are not recorded.
+
+    :param conn: A connection returned by :func:`~fastdupes.open_db`
+    :param groups: A dict mapping sizes to groups of paths, as produced by
+        :func:`~fastdupes.sizeClassifier` with ``keep_uniques=True``.
+    :type groups: :class:`~__builtins__.dict`
+    """
+    def rows():
+        for group in groups.values():
+            for path in group:
+                if isinstance(path, ArchiveMember):
+                    continue
+                try:
+                    filestat = os.lstat(path)
+                except OSError:
+                    continue
+                yield (path, filestat.st_size, filestat.st_mtime,
+                       filestat.st_ino)
+
+    conn.executemany("INSERT OR REPLACE INTO files (path, size, digest, "
+                     "mtime, ino) VALUES (?, ?, NULL, ?, ?)", rows())
+    conn.commit()
+
+def db_record_digests(conn, groups):
+    """Record full-content digests for files already in the store.
+
+    :param conn: A connection returned by :func:`~fastdupes.open_db`
+    :param groups: A dict mapping full SHA1 digests to groups of paths.
+    :type groups: :class:`~__builtins__.dict`
+    """
+    conn.executemany("UPDATE files SET digest = ? WHERE path = ?",
+                     ((buffer(digest), path)
+                      for digest, group in groups.items() for path in group))
+    conn.commit()
+
+def db_record_contents(conn, groups):
+    """Record full-content digests for groups of byte-identical files.
+
+    This is the :option:`--exact` counterpart to
+    :func:`~fastdupes.db_record_digests`. Since every member of a group has
+    the same contents, only one file per group is hashed.
+
+    :param conn: A connection returned by :func:`~fastdupes.open_db`
+    :param groups: A dict of groups of paths, as produced by
+        :func:`~fastdupes.groupByContent`.
+    :type groups: :class:`~__builtins__.dict`
+    """
+    progress.start("Recording digests", len(groups))
+    rows = []
+    for group in groups.values():
+        progress.files += 1
+        for path in group:
+            if isinstance(path, ArchiveMember):
+                continue
+            try:
+                digest = buffer(hashFile(path))
+            except IOError:
+                continue
+            rows.extend((digest, x) for x in group)
+            break
+
+    conn.executemany("UPDATE files SET digest = ? WHERE path = ?", rows)
+    conn.commit()
+    progress.finish("Recorded digests for %d sets of files." % len(groups))
+
+def db_forget(conn, paths):
+    """Remove rows for files which are known to be gone.
+
+    :param conn: A connection returned by :func:`~fastdupes.open_db`
+    :param paths: Paths to remove from the store.
+    """
+    conn.executemany("DELETE FROM files WHERE path = ?",
+                     ((path,) for path in paths))
+    conn.commit()
+
+def db_query(conn, path):
+    """Look up stored files with the same contents as ``path``.
+
+    This costs one :func:`~os.stat` and, only if some stored file has the
+    same size, one full hash of ``path`` plus one :func:`~os.lstat` per
+    candidate match. Rows for files which are gone (or are no longer regular
+    files) are deleted and files whose size, modification time or inode
+    changed since they were recorded are re-hashed.
+
+    Stored files whose digests were never computed (those which had a unique
+    size when scanned) are also hashed here, the first time a query of the
+    same size needs them. Either way, the result is saved so that an
+    unchanged file is never hashed twice.
+
+    :param conn: A connection returned by :func:`~fastdupes.open_db`
+    :param path: The file to check.
+    :type path: :class:`~__builtins__.str`
+
+    :returns: Absolute paths of stored copies of ``path``
+    :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+    """
+    path = os.path.realpath(path)
+    size = os.stat(path).st_size
+
+    if not conn.execute("SELECT 1 FROM files WHERE size = ? AND path != ? "
+                        "LIMIT 1", (size, path)).fetchone():
+        return []
+
+    digest = hashFile(path)
+    rows = conn.execute("SELECT path, digest, mtime, ino FROM files WHERE "
+                        "size = ? AND path != ? AND "
+                        "(digest = ? OR digest IS NULL)",
+                        (size, path, buffer(digest))).fetchall()
+
+    matches = []
+    for stored, stored_digest, mtime, ino in rows:
+        try:
+            filestat = os.lstat(stored)
+        except OSError:
+            filestat = None
+
+        if filestat and stat.S_ISREG(filestat.st_mode):
+            current = (filestat.st_size, filestat.st_mtime, filestat.st_ino)
+            if current != (size, mtime, ino):
+                stored_digest = None
+            if stored_digest is None:
+                try:
+                    stored_digest = hashFile(stored)
+                except IOError:
+                    filestat = None
+
+        if not filestat or not stat.S_ISREG(filestat.st_mode):
+            conn.execute("DELETE FROM files WHERE path = ?", (stored,))
+            continue
+
+        conn.execute("UPDATE files SET size = ?, mtime = ?, ino = ?, "
+                     "digest = ? WHERE path = ?",
+                     current + (buffer(stored_digest), stored))
+        if current[0] == size and str(stored_digest) == digest:
+            matches.append(stored)
+
+    conn.commit()
+    return sorted(matches)
+
+# }}}
+# {{{ Bulk Deletion
+
+#: Rules which can be passed to :option:`--keep`. Each maps a path and its
+#: :func:`~os.stat` result to a sort key and the lowest key is kept.
+KEEP_RULES = {
+    'oldest': lambda path, filestat: filestat.st_mtime,
+    'newest': lambda path, filestat: -filestat.st_mtime,
+    'shortest': lambda path, filestat: len(path),
+    'fewest-links': lambda path, filestat: filestat.st_nlink,
+}
+
+def parse_keep_rules(specs):
+    """Convert :option:`--keep` arguments into a list of sort key functions.
+
+    In addition to the names in :data:`KEEP_RULES`, ``root:PATH`` prefers
+    copies located inside ``PATH``.
+
+    :param specs: Rule names in order of decreasing priority.
+    :type specs: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+
+    :raises ValueError: An unrecognized rule name was given.
+    :rtype: :class:`~__builtins__.list` of ``function(path, stat) -> key``
+    """
+    rules = []
+    for spec in specs:
+        if spec.startswith('root:'):
+            root = os.path.join(os.path.realpath(spec[5:]), '')
+            rules.append(lambda path, filestat, root=root:
+                         not path.startswith(root))
+        elif spec in KEEP_RULES:
+            rules.append(KEEP_RULES[spec])
+        else:
+            raise ValueError("Unknown --keep rule: %s" % spec)
+    return rules
+
+def choose_keeper(stats, rules):
+    """Pick the copy to keep from a group of duplicates.
+
+    :param stats: A dict mapping each path in the group to its
+        :func:`~os.stat` result.
+    :type stats: :class:`~__builtins__.dict`
+
+    :param rules: Sort key functions as returned by
+        :func:`~fastdupes.parse_keep_rules`. Later rules break ties left by
+        earlier ones and the path itself breaks any which remain.
+
+    :rtype: :class:`~__builtins__.str`
+    """
+    return min(stats, key=lambda path: tuple(
+        rule(path, stats[path]) for rule in rules) + (path,))
+
+def _fingerprint(filestat):
+    """Reduce a :func:`~os.stat` result to the fields which must not change
+    between choosing a file for deletion and actually deleting it."""
+    return (filestat.st_dev, filestat.st_ino, filestat.st_mode,
+            filestat.st_size, filestat.st_mtime)
+
+class AuditLog(object):
+    """Thread-safe, append-only writer for :option:`--log` files.
+
+    Each record is written as one line of JSON and flushed immediately.
+    Paths are stored by decoding their raw bytes as latin-1, which maps every
+    possible byte to a code point, so any filename survives the round-trip
+    through JSON. (See :func:`~fastdupes.undo_deletes`)
+
+    :param path: The log file to append to.
+    :type path: :class:`~__builtins__.str`
+    """
+    def __init__(self, path):
+        import json
+        self._dumps = json.dumps
+        self._lock = allocate_lock()
+        self.fobj = open(path, 'a')
+
+    def write(self, record):
+        """Append a record to the log.
+
+        :type record: :class:`~__builtins__.dict`
+        """
+        line = self._dumps(record, encoding='latin-1') + '\n'
+        with self._lock:
+            self.fobj.write(line)
+            self.fobj.flush()
+
+    def close(self):
+        """Close the underlying file."""
+        self.fobj.close()
+
+def _audit_record(path, keeper, filestat):
+    """Start an audit log record for deleting ``path`` in favour of
+    ``keeper``, given the :func:`~os.lstat` result it was planned with."""
+    return {'path': path, 'keeper': keeper, 'size': filestat.st_size,
+            'mtime': filestat.st_mtime, 'mode': filestat.st_mode,
+            'uid': filestat.st_uid, 'gid': filestat.st_gid}
+
+def verify_batch(victims):
+    """Byte-compare each planned deletion against its keeper.
+
+    This runs serially, regardless of :option:`--jobs`, so that only two
+    files are ever being read at once and each is streamed sequentially by
+    :func:`~fastdupes.compareFiles`.
+
+    :param victims: ``(path, keeper, filestat)`` tuples.
+    :type victims: :class:`~__builtins__.list`
+
+    :returns: The victims which passed and audit log records for the ones
+        which didn't.
+    :rtype: ``(list, list)``
+    """
+    passed, failed = [], []
+    progress.start("Verifying duplicates", len(victims))
+    for path, keeper, filestat in victims:
+        progress.files += 1
+        record = _audit_record(path, keeper, filestat)
+        try:
+            if compareFiles(path, keeper):
+                passed.append((path, keeper, filestat))
+                continue
+            record['status'] = 'contents differ'
+        except (IOError, OSError), err:
+            record['status'] = 'error: %s' % err.strerror
+        failed.append(record)
+
+    progress.finish("Verified %d files. (%d failed)" % (len(passed),
+                                                        len(failed)))
+    return passed, failed
+
+def unlinkChecked(job):
+    """Delete a single duplicate if it is still safe to do so.
+
+    The victim must not have been replaced by a symlink or otherwise changed
+    since ``filestat`` was taken and the keeper must still exist.
+
+    If ``log`` is given, a ``removing`` record is written to it before the
+    file is unlinked so that no deletion can ever go unrecorded.
+
+    :param job: A ``(path, keeper, filestat, dry_run, log)`` tuple.
+    :type job: :class:`~__builtins__.tuple`
+
+    :returns: An audit log record describing what was done.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    path, keeper, filestat, dry_run, log = job
+    record = _audit_record(path, keeper, filestat)
+
+    try:
+        current = _stat(path)
+        if stat.S_ISLNK(current.st_mode):
+            record['status'] = 'symlink'
+        elif _fingerprint(current) != _fingerprint(filestat):
+            record['status'] = 'changed'
+        elif not os.path.isfile(keeper):
+            record['status'] = 'keeper missing'
+        elif dry_run:
+            record['status'] = 'dry run'
+        else:
+            if log:
+                log.write(dict(record, status='removing'))
+            os.remove(path)
+            record['status'] = 'removed'
+    except (IOError, OSError), err:
+        record['status'] = 'error: %s' % err.strerror
+    return record
+
+def unlink_batch(victims, jobs=DEFAULTS['jobs'], dry_run=False, log=None):
+    """Run :func:`~fastdupes.unlinkChecked` on many files in parallel.
+
+    :param victims: ``(path, keeper, filestat)`` tuples.
+    :type victims: iterable
+
+    :param jobs: Number of worker threads. Values below 2 disable threading.
+    :type jobs: :class:`~__builtins__.int`
+
+    :param dry_run: If ``True``, only perform the safety checks.
+    :type dry_run: :class:`~__builtins__.bool`
+
+    :param log: Where to record intent before each unlink.
+    :type log: :class:`~fastdupes.AuditLog`
+
+    :returns: An iterator of audit log records in completion order.
+    """
+    work = ((path, keeper, filestat, dry_run, log)
+            for path, keeper, filestat in victims)
+    if jobs < 2:
+        for job in work:
+            yield unlinkChecked(job)
+        return
+
+    # Threads are enough here since unlink() releases the GIL
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        for record in pool.imap_unordered(unlinkChecked, work, UNLINK_BATCH):
+            yield record
+    finally:
+        pool.close()
+        pool.join()
+
+def copySparse(src, dest):
+    """Copy a file's contents to a new file, leaving holes wherever the
+    source reads as zeroes rather than allocating them.
+
+    :param src: The file to copy.
+    :param dest: The path to create. It must not already exist.
+    :type src: :class:`~__builtins__.str`
+    :type dest: :class:`~__builtins__.str`
+    """
+    zeroes = '\0' * CHUNK_SIZE
+    with FileReader(src) as reader:
+        fobj = os.fdopen(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0600), 'wb')
+        with fobj:
+            for block in iter(lambda: reader.read(CHUNK_SIZE), ''):
+                if block == zeroes[:len(block)]:
+                    fobj.seek(len(block), os.SEEK_CUR)
+                else:
+                    fobj.write(block)
+            fobj.truncate()  # Extends the file over any trailing hole
+
+def undo_deletes(log_paths, dry_run=False):
+    """Code to handle the :option:`--undo` command-line option.
+
+    Every file recorded as removed (or about to be removed) in the given
+    :option:`--log` files is restored by copying its keeper back into place
+    (with :func:`~fastdupes.copySparse`) and resetting its mode, ownership
+    and mtime.
+
+    :param log_paths: Audit logs written by :func:`~fastdupes.delete_dupes`
+    :type log_paths: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+
+    :param dry_run: If ``True``, only list what would be restored.
+    :type dry_run: :class:`~__builtins__.bool`
+
+    :returns: An exit code: ``0`` if everything was restored, ``1`` otherwise.
+    :rtype: :class:`~__builtins__.int`
+    """
+    import json
+
+    # A "removing" record with no outcome means we were killed mid-unlink
+    pending, confirmed = {}, set()
+    for log_path in log_paths:
+        with open(log_path) as fobj:
+            for line in fobj:
+                record = json.loads(line)
+                path = record['path'].encode('latin-1')
+                if record['status'] in ('removing', 'removed'):
+                    pending[path] = record
+                    if record['status'] == 'removed':
+                        confirmed.add(path)
+                elif path in pending and path not in confirmed:
+                    del pending[path]  # The unlink itself failed
+
+    failed = False
+    for path in sorted(pending):
+        record = pending[path]
+        keeper = record['keeper'].encode('latin-1')
+        if os.path.lexists(path):
+            if path in confirmed:
+                print "Not overwriting %s" % path
+                failed = True
+            continue
+
+        print "Restoring %s" % path
+        if dry_run:
+            continue
+        try:
+            copySparse(keeper, path)
+            if 'mode' in record:
+                os.chown(path, record['uid'], record['gid'])
+                os.chmod(path, stat.S_IMODE(record['mode']))
+            os.utime(path, (record['mtime'], record['mtime']))
+        except (IOError, OSError), err:
+            print "Could not restore %s: %s" % (path, err)
+            failed = True
+    return 1 if failed else 0
+
 # }}}
 # {{{ User Interface
 
@@ -459,7 +1945,25 @@ def pruneUI(dupeList, mainPos=1, mainLen=1):
 
 # }}}
 
-def find_dupes(paths, exact=False, ignores=None, min_size=0):
+def pruneReference(groups, reference):
+    """Discard groups which can't relate a candidate to a reference file.
+
+    :param groups: A dict mapping keys to sets of paths.
+    :type groups: :class:`~__builtins__.dict`
+
+    :param reference: Paths which were found under reference roots.
+    :type reference: :class:`~__builtins__.set`
+
+    :returns: Only the groups containing both candidate and reference files.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    return dict((key, group) for key, group in groups.items()
+                if not reference.isdisjoint(group) and
+                not reference.issuperset(group))
+
+def find_dupes(paths, exact=False, ignores=None, min_size=0, db=None,
+               reference=None, archives=False, one_file_system=False,
+               follow_symlinks=False):
     """High-level code to walk a set of paths and find duplicate groups.
 
     :param exact: Whether to compare file contents by hash or by reading
@@ -470,22 +1974,78 @@ def find_dupes(paths, exact=False, ignores=None, min_size=0):
     :param ignores: See :meth:`~fastdupes.getPaths`
     :param min_size: See :meth:`~fastdupes.sizeClassifier`
 
-    :returns: A list of groups of files with identical contents
+    :param db: If provided, sizes and digests will be recorded in this store
+        for later use by :func:`~fastdupes.db_query`.
+    :type db: :class:`sqlite3.Connection`
+
+    :param reference: Paths to existing files (eg. an archive). If provided,
+        only duplicates of files in ``paths`` which already exist somewhere
+        in ``reference`` will be sought. Reference files are never hashed
+        unless some candidate file has the same size.
+    :type reference: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+
+    :param archives: See :meth:`~fastdupes.getPaths`
+    :param one_file_system: See :meth:`~fastdupes.getPaths`
+    :param follow_symlinks: See :meth:`~fastdupes.getPaths`
+
+    :returns: A list of groups of files with identical contents. (With
+        ``reference``, a dict mapping each candidate file to a list
+        containing itself followed by its existing copies.)
     :rtype: ``[[path, ...], [path, ...]]``
     """
-    groups = {'': getPaths(paths, ignores)}
-    groups = groupBy(groups, sizeClassifier, 'sizes', min_size=min_size)
+    walk_opts = {'archives': archives, 'one_file_system': one_file_system,
+                 'follow_symlinks': follow_symlinks}
+    candidates = getPaths(paths, ignores, **walk_opts)
+    groups = {'': candidates}
+
+    refs = None
+    if reference:
+        refs = set(getPaths(reference, ignores, **walk_opts))
+        refs.difference_update(candidates)
+        groups[''] = candidates + list(refs)
+
+    groups = groupBy(groups, sizeClassifier, 'sizes', bool(db),
+                     min_size=min_size)
+
+    if db:
+        # Files with unique sizes still need to be queryable later
+        db_record_sizes(db, groups)
+        groups = dict((x, y) for x, y in groups.items() if len(y) > 1)
+
+    if archives:
+        groups = groupBy(groups, crcClassifier, 'stored CRCs')
+
+    # Reference-only groups get pruned before anything is read
+    if refs is not None:
+        groups = pruneReference(groups, refs)
 
     # This serves one of two purposes depending on run-mode:
     # - Minimize number of files checked by full-content comparison (hash)
     # - Minimize chances of file handle exhaustion and limit seeking (exact)
-    groups = groupBy(groups, hashClassifier, 'header hashes', limit=HEAD_SIZE)
+    groups = groupBy(groups, hashClassifier, 'header hashes',
+                     overlapping=archives, limit=HEAD_SIZE)
+    if refs is not None:
+        groups = pruneReference(groups, refs)
+
+    # Huge sparse images would otherwise cost a full SHA1 of their zeroes
+    holes, groups = splitHoles(groups)
 
     if exact:
         groups = groupBy(groups, groupByContent, fun_desc='contents')
+        if db:
+            db_record_contents(db, groups)
     else:
-        groups = groupBy(groups, hashClassifier, fun_desc='hashes')
-
+        groups = groupBy(groups, hashClassifier, fun_desc='hashes',
+                         limit=None)
+        if db:
+            db_record_digests(db, groups)
+    groups.update(holes)
+
+    if refs is not None:
+        groups = pruneReference(groups, refs)
+        groups = dict((path, [path] + sorted(group & refs))
+                      for group in groups.values()
+                      for path in sorted(group - refs))
     return groups
 
 def print_defaults():
@@ -497,9 +2057,42 @@ def print_defaults():
             value = ', '.join(value)
         print "%*s: %s" % (maxlen, key, value)
 
-def delete_dupes(groups, prefer_list=None, interactive=True, dry_run=False):
+def query_db(db_path, paths):
+    """Code to handle the :option:`--query` command-line option.
+
+    Each queried file which is already present in the store is printed,
+    followed by the stored copies, in the same format as a duplicate group.
+
+    :param db_path: See :func:`~fastdupes.open_db`
+    :param paths: Files to look up.
+    :type paths: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+
+    :returns: An exit code: ``2`` if any file couldn't be checked, else
+        ``0`` if any file was found and ``1`` otherwise.
+    :rtype: :class:`~__builtins__.int`
+    """
+    conn, found, failed = open_db(db_path), False, False
+    for path in paths:
+        try:
+            matches = db_query(conn, path)
+        except (IOError, OSError), err:
+            out.write("Could not check %s: %s" % (path, err.strerror),
+                      newline=True)
+            failed = True
+            continue
+        if matches:
+            print '\n'.join([path] + matches) + '\n'
+            found = True
+    return 2 if failed else 0 if found else 1
+
+def delete_dupes(groups, prefer_list=None, interactive=True, dry_run=False,
+                 keep_rules=None, jobs=DEFAULTS['jobs'], log_path=None,
+                 verify=False, db=None, protect=None):
     """Code to handle the :option:`--delete` command-line option.
 
+    All decisions are made before anything is deleted, then the unlinks are
+    carried out in parallel by :func:`~fastdupes.unlink_batch`.
+
     :param groups: A list of groups of paths.
     :type groups: iterable
 
@@ -513,32 +2106,116 @@ def delete_dupes(groups, prefer_list=None, interactive=True, dry_run=False):
     :param dry_run: If ``True``, only pretend to delete files.
     :type dry_run: :class:`~__builtins__.bool`
 
-    .. todo:: Add a secondary check for symlinks for safety.
+    :param keep_rules: Sort key functions from
+        :func:`~fastdupes.parse_keep_rules` used to pick a keeper instead of
+        prompting when no ``prefer_list`` entries match.
+    :type keep_rules: :class:`~__builtins__.list`
+
+    :param jobs: See :func:`~fastdupes.unlink_batch`
+
+    :param log_path: If provided, a JSON record of every deletion attempt will
+        be appended to this file, one object per line.
+    :type log_path: :class:`~__builtins__.str`
+
+    :param verify: If ``True``, byte-compare each file against its keeper
+        with :func:`~fastdupes.verify_batch` before any unlinking starts.
+    :type verify: :class:`~__builtins__.bool`
+
+    :param db: If provided, rows for removed files are deleted from this
+        store so later queries don't report them.
+    :type db: :class:`sqlite3.Connection`
+
+    :param protect: Paths which must never be removed, whatever
+        ``prefer_list`` or ``keep_rules`` say. (eg. :option:`--reference`
+        copies)
+    :type protect: :class:`~__builtins__.set`
+
+    :returns: The number of files which were (or would be) removed.
+    :rtype: :class:`~__builtins__.int`
     """
-    prefer_list = prefer_list or []
+    prefer_list, protect = prefer_list or [], protect or set()
     prefer_re = multiglob_compile(prefer_list, prefix=True)
 
+    victims = []
     for pos, group in enumerate(groups.values()):
-        preferred = [x for x in group if prefer_re.match(x)]
+        # Snapshot everything now so unlinkChecked can detect later changes
+        stats = {}
+        for path in group:
+            if isinstance(path, ArchiveMember):
+                continue  # We don't rewrite archives
+            try:
+                stats[path] = _stat(path)
+            except OSError:
+                pass  # Vanished since it was hashed. Just leave it out.
+        group = sorted(stats)
+        if len(group) < 2:
+            continue
+
+        # Protected copies count as preferred, so they're kept and no prompt or
+        # --keep rule gets a say in groups which contain them
+        preferred = [x for x in group if x in protect or prefer_re.match(x)]
         pruneList = [x for x in group if x not in preferred]
         if not preferred:
-            if interactive:
+            if keep_rules:
+                preferred = [choose_keeper(stats, keep_rules)]
+                pruneList = [x for x in group if x not in preferred]
+            elif interactive:
                 pruneList = pruneUI(group, pos + 1, len(groups))
                 preferred = [x for x in group if x not in pruneList]
             else:
                 preferred, pruneList = pruneList, []
 
         assert preferred  # Safety check
-        for path in pruneList:
-            print "Removing %s" % path
-            if not dry_run:
-                os.remove(path)
-
-def main():
-    """The main entry point, compatible with setuptools."""
+        victims.extend((x, preferred[0], stats[x]) for x in pruneList)
+
+    failed = []
+    if verify:
+        victims, failed = verify_batch(victims)
+
+    from itertools import chain
+    log = log_path and AuditLog(log_path)
+    removed, skipped, gone = 0, 0, []
+    progress.start("Removing duplicates", len(victims) + len(failed))
+    try:
+        for record in chain(failed, unlink_batch(victims, jobs, dry_run, log)):
+            progress.files += 1
+            if record['status'] in ('removed', 'dry run'):
+                removed += 1
+                if record['status'] == 'removed':
+                    gone.append(record['path'])
+                if dry_run:
+                    print "Removing %s" % record['path']
+            else:
+                skipped += 1
+                print "Skipping %s (%s)" % (record['path'], record['status'])
+
+            if log:
+                log.write(record)
+    finally:
+        if log:
+            log.close()
+        if db:
+            db_forget(db, gone)
+
+    progress.finish("%s %d files. (%d skipped)" % (
+        dry_run and "Would remove" or "Removed", removed, skipped))
+    return removed
+
+def print_groups(groups):
+    """Print each group of duplicates as a blank-line-separated list."""
+    for dupeSet in groups.values():
+        print '\n'.join(dupeSet) + '\n'
+
+def make_parser():
+    """Build the :mod:`optparse` parser used by :func:`~fastdupes.main`.
+
+    :rtype: :class:`optparse.OptionParser`
+    """
     # pylint: disable=bad-continuation
     from optparse import OptionParser, OptionGroup
-    parser = OptionParser(usage="%prog [options] <folder path> ...",
+    parser = OptionParser(usage="%prog [options] <folder path> ...\n"
+            "       %prog --db=FILE --query <file path> ...\n"
+            "       %prog [--dry-run] --undo <log file> ...",
             version="%s v%s" % (__appname__, __version__))
     parser.add_option('-D', '--defaults', action="store_true", dest="defaults",
         default=False, help="Display the default values for options which take"
@@ -550,6 +2227,14 @@ def main():
         " of disk seeks, so, on traditional moving-platter media, this trades"
         " a LOT of performance for a very tiny amount of safety most people"
         " don't need.")
+    parser.add_option('--db', action="store", dest="db", metavar="FILE",
+        help="Record the sizes and hashes found by this run in the given "
+        "SQLite database. With --query, check the given files against the "
+        "stored results instead of scanning.")
+    parser.add_option('--query', action="store_true", dest="query",
+        default=False, help="Treat the arguments as files to look up in the "
+        "--db database rather than folders to scan. Exits with 0 if any are "
+        "already stored, 1 if none are and 2 on errors.")
     # XXX: Should I add --verbose and/or --quiet?
 
     filter_group = OptionGroup(parser, "Input Filtering")
@@ -558,6 +2243,22 @@ def main():
         " added to the internal blacklist. This option can be used multiple"
         " times. Provide a dash (-) as your first exclude to override the"
         " pre-programmed defaults.")
+    filter_group.add_option('--one-file-system', action="store_true",
+        dest="one_file_system", help="Don't descend into directories on "
+        "other filesystems than the path they were found under.")
+    filter_group.add_option('--follow-symlinks', action="store_true",
+        dest="follow_symlinks", help="Descend into symlinked directories. "
+        "Each directory is still only examined once, so symlink loops and "
+        "links back into a path being scanned are harmless.")
+    filter_group.add_option('--archives', action="store_true",
+        dest="archives", help="Also compare the files inside zip and tar "
+        "archives without extracting them. Archive members are listed as "
+        "ARCHIVE!/MEMBER and will never be deleted.")
+    filter_group.add_option('--reference', action="append",
+        dest="reference", metavar="PATH", default=[], help="Only report files"
+        " from the given paths which already exist under PATH, rather than "
+        "all duplicates. Files under PATH are only hashed if a file being "
+        "checked has the same size. This option can be used multiple times.")
     filter_group.add_option('--min-size', action="store", type="int",
         dest="min_size", metavar="X", help="Specify a non-default minimum size"
         ". Files below this size (default: %default bytes) will be ignored.")
@@ -578,10 +2279,58 @@ def main():
     behaviour_group.add_option('--noninteractive', action="store_true",
         dest="noninteractive", help="When using --delete, automatically assume"
         " 'all' for any groups with no --prefer matches rather than prompting")
+    behaviour_group.add_option('--verify', action="store_true",
+        dest="verify", help="When using --delete, compare each file byte-for-"
+        "byte against the copy being kept before deleting it. This gives "
+        "deletions the safety of --exact while only reading the files which "
+        "are actually about to be removed.")
+    behaviour_group.add_option('--keep', action="append", dest="keep",
+        metavar="RULE", default=[], help="When using --delete, automatically "
+        "keep one copy from any group with no --prefer matches rather than "
+        "prompting. RULE may be one of %s or root:PATH. Repeat this option to"
+        " break ties." % ', '.join(sorted(KEEP_RULES)))
+    behaviour_group.add_option('-j', '--jobs', action="store", type="int",
+        dest="jobs", metavar="N", help="Number of files to delete in parallel"
+        " (default: %default)")
+    behaviour_group.add_option('--log', action="store", dest="log",
+        metavar="FILE", help="Append a JSON record of every deletion to FILE."
+        " Files deleted with --log can be restored with --undo.")
+    behaviour_group.add_option('--undo', action="store_true", dest="undo",
+        default=False, help="Treat the arguments as --log files rather than "
+        "folders and restore the files they record as removed by copying "
+        "their keepers back into place.")
     parser.add_option_group(behaviour_group)
+
+    io_group = OptionGroup(parser, "Disk I/O")
+    io_group.add_option('--drop-cache', action="store_true",
+        dest="drop_cache", help="Advise the OS to drop file contents from the"
+        " page cache as soon as they've been read so that scanning doesn't "
+        "evict other applications' data. Pages which were already cached are "
+        "left alone, and nothing is dropped where mincore() can't tell which "
+        "those are. (Doesn't apply to --archives members)")
+    io_group.add_option('--direct', action="store_true", dest="direct",
+        help="Bypass the page cache entirely using O_DIRECT on filesystems "
+        "which support it. (Doesn't apply to --archives members)")
+    io_group.add_option('--max-read-rate', action="store", dest="max_rate",
+        metavar="RATE", help="Limit reads to RATE bytes per second. (K, M and"
+        " G suffixes are accepted. Archive members count their decompressed "
+        "size)")
+    parser.add_option_group(io_group)
     parser.set_defaults(**DEFAULTS)  # pylint: disable=W0142
+    return parser
+
+def main():
+    """The main entry point, compatible with setuptools."""
+    args = sys.argv[1:]
+
+    # Plain scans (eg. from ingest hooks) don't need optparse at all
+    if args and not [x for x in args if x.startswith('-')]:
+        print_groups(find_dupes(args, ignores=DEFAULTS['exclude'],
+                                min_size=DEFAULTS['min_size']))
+        return
 
-    opts, args = parser.parse_args()
+    parser = make_parser()
+    opts, args = parser.parse_args(args)
 
     if '-' in opts.exclude:
         opts.exclude = opts.exclude[opts.exclude.index('-') + 1:]
@@ -592,14 +2341,41 @@ def main():
         print_defaults()
         sys.exit()
 
-    groups = find_dupes(args, opts.exact, opts.exclude, opts.min_size)
+    try:
+        keep_rules = parse_keep_rules(opts.keep)
+        read_policy.max_rate = opts.max_rate and parse_size(opts.max_rate)
+    except ValueError, err:
+        parser.error(str(err))
+    read_policy.drop_cache, read_policy.direct = opts.drop_cache, opts.direct
+
+    if opts.query:
+        if not opts.db:
+            parser.error("--query requires --db")
+        elif not os.path.isfile(opts.db):
+            # A typo shouldn't quietly create an empty store that matches
+            # nothing
+            parser.error("No database found at %s" % opts.db)
+        sys.exit(query_db(opts.db, args))
+
+    elif opts.undo:
+        sys.exit(undo_deletes(args, opts.dry_run))
+
+    db = opts.db and open_db(opts.db)
+    groups = find_dupes(args, opts.exact, opts.exclude, opts.min_size, db,
+                        opts.reference, opts.archives,
+                        opts.one_file_system, opts.follow_symlinks)
+
+    # Never delete the existing copies when cross-referencing
+    refs = set()
+    if opts.reference:
+        refs.update(x for group in groups.values() for x in group[1:])
 
     if opts.delete:
         delete_dupes(groups, opts.prefer, not opts.noninteractive,
-                     opts.dry_run)
+                     opts.dry_run, keep_rules, opts.jobs, opts.log,
+                     opts.verify, db, refs)
     else:
-        for dupeSet in groups.values():
-            print '\n'.join(dupeSet) + '\n'
+        print_groups(groups)
 
 if __name__ == '__main__':
     main()